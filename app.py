@@ -1,32 +1,7 @@
 import streamlit as st
-import os
-import re
-import psycopg2
-from openai import AzureOpenAI
-from dotenv import load_dotenv
+from psycopg.errors import QueryCanceled
 
-
-load_dotenv()
-
-MODEL = "gpt-4o"
-
-client = AzureOpenAI(
-    api_key=os.environ["AZURE_OPENAI_API_KEY"],
-    api_version="2025-04-01-preview",
-    azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-    timeout=60
-)
-
-
-# -------- PostgreSQL CONNECTION ----------
-def get_pg_connection():
-    return psycopg2.connect(
-        host=os.getenv("PG_HOST", "localhost"),
-        database=os.getenv("PG_DB", "analytics_chatbot"),
-        user=os.getenv("PG_USER", "postgres"),
-        password=os.getenv("PG_PASSWORD", "password"),
-        port=os.getenv("PG_PORT", 5432)
-    )
+from chatbot.core import *
 
 
 # -------- LLM PROMPTS ----------
@@ -48,6 +23,46 @@ Summarize the SQL result in 1–3 sentences.
 User question, the SQL used, and the query results will be provided.
 """
 
+
+# -------- LLM CALLS ----------
+def sql_messages(prompt: str):
+    return [
+        {"role": "system", "content": SQL_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+async def generate_sql(prompt: str) -> str:
+    sql_response = await cached_completion(messages=sql_messages(prompt))
+    return sql_response.choices[0].message.content.strip()
+
+
+async def summarize(prompt: str, sql_query: str, rows, placeholder, truncated: bool = False, cached: bool = True) -> str:
+    # Same query, same result: reuse the summary instead of asking the LLM again.
+    # Only for rows the database returned; errors carry no result to key on.
+    cache = st.session_state.setdefault("_sum_cache", {})
+    key = summary_key(sql_query, rows) if cached else None
+    if key in cache:
+        placeholder.markdown(cache[key])
+        return cache[key]
+
+    summary_payload = f"""
+    User question: {prompt}
+    SQL executed: {sql_query}
+    Result{f" (first {len(rows)} rows only, the query returned more)" if truncated else ""}: {rows}
+    """
+    summary, _ = await stream_completion(
+        placeholder,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": summary_payload},
+        ],
+    )
+    if key is not None:
+        cache_put(cache, key, summary, LLM_CACHE_SIZE)
+    return summary
+
+
 # -------- STREAMLIT UI ----------
 st.title("PostgreSQL LLM Chatbot")
 st.caption("Ask questions about your data. The LLM writes SQL → runs it → summarizes results.")
@@ -80,103 +95,50 @@ if prompt:
         st.markdown(prompt)
 
     # ====== 1. Generate SQL ======
-    sql_response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": SQL_PROMPT},
-            {"role": "user", "content": prompt},
-        ],
-    )
+    raw_sql = run_async(generate_sql(prompt))
     # sql_query = sql_response.choices[0].message.content.strip()
     #  sql_query = re.sub(r'```(?:sql)?\s*|\s*```', '', sql_response.choices[0].message.content.strip(),
     #                    flags=re.IGNORECASE)
 
-    raw_sql = sql_response.choices[0].message.content.strip()
-
-
-    # ── Robust SQL extraction (handles multiple common patterns) ──
-    def extract_sql(text: str) -> str:
-        """
-        Extract SQL from LLM output, removing Markdown fences, explanations, etc.
-        Returns clean SQL or raises a clear error.
-        """
-        # Remove Markdown code blocks (```sql ... ``` or ``` ... ```)
-        sql = re.sub(r'^```(?:sql)?\s*', '', text, flags=re.IGNORECASE)
-        sql = re.sub(r'```$', '', sql)
-
-        # Remove any leading/trailing explanations (common in GPT-4o)
-        # Keep only the first valid SQL statement if multiple are returned
-        sql = sql.strip()
-
-        # Basic safety: ensure it starts with a SQL keyword
-        if not re.match(r'^\s*(SELECT|WITH|EXPLAIN|SHOW|PRAGMA)', sql, re.IGNORECASE):
-            raise ValueError("Generated text does not appear to be a valid SQL query")
-
-        # Optional but recommended: limit length to prevent injection/runaway queries
-        if len(sql) > 2000:
-            raise ValueError("Generated SQL is too long")
-
-        return sql
-
-
+    sql_failed, truncated = False, False
     try:
         sql_query = extract_sql(raw_sql)
     except Exception as extract_err:
         sql_query = f"Failed to extract clean SQL: {extract_err}"
         rows = None
+        sql_failed = True
     else:
         st.code(sql_query, language="sql")  # now safe to display
 
         # ====== 2. Execute SQL safely ======
-        conn = get_pg_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute(sql_query)
-            if sql_query.strip().upper().startswith("SELECT"):
-                rows = cur.fetchall()
-                column_names = [desc[0] for desc in cur.description]
-                # Convert to list of dicts for nicer summary
-                rows = [dict(zip(column_names, row)) for row in rows]
-            else:
-                conn.commit()
-                rows = f"Query executed successfully. Rows affected: {cur.rowcount}"
-        except Exception as e:
-            rows = f"SQL Execution Error: {str(e)}"
-        finally:
-            cur.close()
-            conn.close()
+        with get_pool().connection() as conn:
+            try:
+                if sql_query.strip().upper().startswith("SELECT"):
+                    column_names, rows, truncated = fetch_rows(conn, sql_query)
+                    # Convert to list of dicts for nicer summary
+                    rows = [dict(zip(column_names, row)) for row in rows]
+                else:
+                    with conn.cursor() as cur:
+                        cur.execute(sql_query)
+                        conn.commit()
+                        rows = f"Query executed successfully. Rows affected: {cur.rowcount}"
+            except QueryCanceled:
+                rows = f"SQL Execution Error: {QUERY_TIMEOUT_MESSAGE}"
+                sql_failed = True
+            except Exception as e:
+                rows = f"SQL Execution Error: {str(e)}"
+                sql_failed = True
+
+    # Don't keep SQL that failed, so asking again gets a fresh attempt
+    if sql_failed:
+        forget_completion(sql_messages(prompt))
 
     # Show the generated SQL (debugging)
     st.code(sql_query, language="sql")
 
-    # ====== 2. Run SQL against PostgreSQL ======
-    conn = get_pg_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(sql_query)
-        rows = cur.fetchall()
-    except Exception as e:
-        rows = f"SQL Error: {str(e)}"
-    conn.commit()
-    cur.close()
-    conn.close()
-
     # ====== 3. Summarize results ======
-    summary_payload = f"""
-    User question: {prompt}
-    SQL executed: {sql_query}
-    Result: {rows}
-    """
-    summary_response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": SUMMARY_PROMPT},
-            {"role": "user", "content": summary_payload},
-        ],
-    )
-    summary = summary_response.choices[0].message.content
+    # Display assistant response in chat message container, streaming it as it is generated
+    with st.chat_message("assistant"):
+        summary = run_async(summarize(prompt, sql_query, rows, st.empty(), truncated, cached=not sql_failed))
 
     st.session_state.messages.append({"role": "assistant", "content": summary})
-    # Display assistant response in chat message container
-    with st.chat_message("assistant"):
-        st.markdown(summary)
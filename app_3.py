@@ -1,35 +1,20 @@
 import streamlit as st
-import os
-import psycopg2
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-import json
+from openai.types.chat.completion_create_params import Function
+from psycopg.errors import QueryCanceled
+from pydantic import TypeAdapter
+import orjson
 
-load_dotenv()
+from chatbot.core import *
 
-MODEL = "gpt-4o"
 
-client = AzureOpenAI(
-    api_key=os.environ["AZURE_OPENAI_API_KEY"],
-    api_version="2025-04-01-preview",
-    azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-    timeout=60
-)
-
-
-# Database connection function
 def get_db_connection():
-    return psycopg2.connect(
-        host=os.environ.get("PGHOST", "localhost"),
-        database=os.environ.get("PGDATABASE", "postgres"),
-        user=os.environ.get("PGUSER", "postgres"),
-        password=os.environ.get("PGPASSWORD", ""),
-        port=os.environ.get("PGPORT", "5432")
-    )
+    """Borrow a pooled connection, returned to the pool when the with block ends"""
+    # This app reads libpq's own PG* variable names
+    return get_pool(PG_LIBPQ).connection()
 
 
 # Function definitions for AI
-functions = [
+FUNCTIONS = [
     {
         "name": "query_database",
         "description": "Execute a SQL query on the PostgreSQL database and return the results",
@@ -60,6 +45,12 @@ functions = [
     }
 ]
 
+@st.cache_resource(show_spinner=False)
+def get_functions():
+    """FUNCTIONS validated against the SDK's Function type, once per process"""
+    return TypeAdapter(list[Function]).validate_python(FUNCTIONS)
+
+
 # Available functions for the AI to call
 available_functions = {
     "query_database": lambda query: execute_sql_query(query),
@@ -67,36 +58,52 @@ available_functions = {
 }
 
 
-def execute_sql_query(query):
-    """Execute SQL query and return results"""
+def call_function(function_name, arguments):
+    """Run one function call from the model; a malformed or unknown call gets an error result instead of raising"""
+    function_to_call = available_functions.get(function_name)
+    if function_to_call is None:
+        return {"error": f"Unknown function {function_name}."}
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(query)
+        function_args = orjson.loads(arguments or "{}")
+    except orjson.JSONDecodeError:
+        function_args = None
+    if not isinstance(function_args, dict):
+        return {"error": "The arguments must be a JSON object."}
 
-        if query.strip().lower().startswith(('select', 'show', 'describe')):
-            result = cur.fetchall()
-            columns = [desc[0] for desc in cur.description]
-            return {"columns": columns, "data": result, "row_count": len(result)}
-        else:
-            conn.commit()
-            return {"message": f"Query executed successfully. Rows affected: {cur.rowcount}"}
+    try:
+        if function_name == "get_table_schema":
+            return function_to_call(function_args.get('table_name'))
+        return function_to_call(**function_args)
+    except TypeError as e:
+        # Missing or unexpected argument names
+        return {"error": f"Bad arguments for {function_name}: {e}"}
 
+
+def execute_sql_query(query):
+    """Execute SQL query and return results"""
+    try:
+        with get_db_connection() as conn:
+            if query.strip().lower().startswith(('select', 'show', 'describe')):
+                columns, result, truncated = fetch_rows(conn, query)
+                row_count = f"at least {len(result)} (truncated)" if truncated else len(result)
+                return {"columns": columns, "data": result, "row_count": row_count}
+            else:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+                    conn.commit()
+                    return {"message": f"Query executed successfully. Rows affected: {cur.rowcount}"}
+
+    except QueryCanceled:
+        # Tell the model why, so it can answer with or suggest a cheaper query
+        return {"error": QUERY_TIMEOUT_MESSAGE}
     except Exception as e:
         return {"error": str(e)}
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-def get_table_schema(table_name=None):
-    """Get schema information for tables"""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_table_schema(table_name=None):
+    """Read schema information for tables, cached for 5 minutes per table_name"""
+    with get_db_connection() as conn, conn.cursor() as cur:
         if table_name:
             # Get schema for specific table
             cur.execute("""
@@ -117,63 +124,58 @@ def get_table_schema(table_name=None):
             tables = cur.fetchall()
             return {"tables": [table[0] for table in tables]}
 
+
+def get_table_schema(table_name=None):
+    """Get schema information for tables"""
+    # Errors are returned here rather than inside the cached function so they are not cached
+    try:
+        return fetch_table_schema(table_name)
     except Exception as e:
         return {"error": str(e)}
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-def process_user_input(user_input, conversation_history):
-    """Process user input using OpenAI with function calling"""
+async def process_user_input(user_input, conversation_history, placeholder, summary=None, upto=1):
+    """Process user input using OpenAI with function calling, streaming the reply into placeholder"""
 
     messages = conversation_history + [{"role": "user", "content": user_input}]
 
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        functions=functions,
+    content, function_call = await stream_completion(
+        placeholder,
+        messages=pack_history(messages, summary, upto),
+        functions=get_functions(),
         function_call="auto"
     )
 
-    response_message = response.choices[0].message
-
     # Check if function call is needed
-    if response_message.function_call:
-        function_name = response_message.function_call.name
-        function_args = json.loads(response_message.function_call.arguments)
+    if function_call:
+        function_name = function_call["name"]
 
         st.sidebar.write(f"🔄 Calling function: {function_name}")
-        st.sidebar.write(f"Arguments: {function_args}")
+        st.sidebar.write(f"Arguments: {function_call['arguments']}")
 
         # Execute the function
-        function_to_call = available_functions[function_name]
-        if function_name == "get_table_schema":
-            function_response = function_to_call(function_args.get('table_name'))
-        else:
-            function_response = function_to_call(**function_args)
+        function_response = call_function(function_name, function_call["arguments"])
 
         # Add function response to conversation
+        function_content = orjson.dumps(function_response, default=str).decode()
         messages.append({
             "role": "function",
             "name": function_name,
-            "content": json.dumps(function_response, default=str)
+            "content": function_content
         })
 
         # Get final response from AI
-        second_response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages
+        final_content, _ = await stream_completion(
+            placeholder,
+            messages=pack_history(messages, summary, upto)
         )
 
-        return second_response.choices[0].message.content, messages + [
-            {"role": "function", "name": function_name, "content": json.dumps(function_response, default=str)},
-            {"role": "assistant", "content": second_response.choices[0].message.content}
+        return final_content, messages + [
+            {"role": "function", "name": function_name, "content": function_content},
+            {"role": "assistant", "content": final_content}
         ]
 
-    return response_message.content, messages + [{"role": "assistant", "content": response_message.content}]
+    return content, messages + [{"role": "assistant", "content": content}]
 
 
 # Streamlit UI
@@ -222,11 +224,16 @@ if user_input := st.chat_input("Ask a question about your database..."):
     with st.chat_message("user"):
         st.markdown(user_input)
 
+    # Summarize older history in the background while this turn runs
+    summary, upto = update_history_summary(st.session_state.messages)
+
     # Process user input
     with st.chat_message("assistant"):
+        response_placeholder = st.empty()
         with st.spinner("Thinking..."):
-            response, updated_messages = process_user_input(user_input, st.session_state.messages)
-            st.markdown(response)
+            response, updated_messages = run_async(
+                process_user_input(user_input, st.session_state.messages, response_placeholder, summary, upto)
+            )
 
     # Update conversation history
     st.session_state.messages = updated_messages
@@ -1,38 +1,55 @@
 import streamlit as st
-from openai import AzureOpenAI
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
-import os
-import json
-import pandas as pd
+from openai.types.chat import ChatCompletionToolParam
+from pydantic import TypeAdapter
+from psycopg.errors import QueryCanceled
+import asyncio
+import orjson
 import traceback
 
-load_dotenv()
+from chatbot.core import *
 
 # ============================
 # Configuration
 # ============================
-client = AzureOpenAI(
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_version="2024-08-01-preview",
-    timeout=60
-)
+client = get_llm()
+
+# ============================
+# Function definition for Azure OpenAI
+# ============================
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_sql_query",
+            "description": "Execute a read-only SQL query on the PostgreSQL database and return results.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "sql": {
+                        "type": "string",
+                        "description": "The SQL query to execute. Must be SELECT only. Limit results with LIMIT 100."
+                    }
+                },
+                "required": ["sql"],
+                "additionalProperties": False
+            }
+        }
+    }
+]
+
+
+# Validated against the SDK's tool type once per process; every rerun reuses the result
+@st.cache_resource(show_spinner=False)
+def get_tools():
+    return TypeAdapter(list[ChatCompletionToolParam]).validate_python(TOOLS)
 
-MODEL = "gpt-4o"
 
+def get_db_connection(pool=None):
+    """Borrow a pooled connection; dict rows, returned to the pool on exit.
 
-# PostgreSQL connection (read-only recommended)
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv("PG_HOST", "localhost"),
-        database=os.getenv("PG_DB", "analytics_chatbot"),
-        user=os.getenv("PG_USER", "postgres"),
-        password=os.getenv("PG_PASSWORD", "password"),
-        port=os.getenv("PG_PORT", 5432),
-        cursor_factory=RealDictCursor,
-    )
+    Worker threads pass the pool in, since st.cache_resource belongs to the script thread.
+    """
+    return (pool or get_pool(dict_rows=True)).connection()
 
 
 # ============================
@@ -61,32 +78,61 @@ if "messages" not in st.session_state:
 
 # Display chat history
 for msg in st.session_state.messages[1:]:  # skip system message
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
+    # Tool calls and tool results are for the model, not the chat log
+    if msg["role"] in ("user", "assistant") and msg.get("content"):
+        with st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
 
 # ============================
-# Function definition for Azure OpenAI
+# Tool execution
 # ============================
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "execute_sql_query",
-            "description": "Execute a read-only SQL query on the PostgreSQL database and return results.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "sql": {
-                        "type": "string",
-                        "description": "The SQL query to execute. Must be SELECT only. Limit results with LIMIT 100."
-                    }
-                },
-                "required": ["sql"],
-                "additionalProperties": False
-            }
-        }
-    }
-]
+def run_tool(pool, tool_call):
+    """Run one tool call in a worker thread.
+
+    Returns the tool message for the model, plus rows to display and an error traceback;
+    Streamlit elements are drawn by the caller on the script thread.
+    """
+    function_name = tool_call["function"]["name"]
+    preview, error_text = None, None
+    sql = parse_sql_argument(tool_call["function"]["arguments"])
+
+    if function_name != "execute_sql_query":
+        result = f"Error: Unknown function {function_name}."
+    elif sql is None:
+        result = SQL_ARGUMENT_ERROR
+    # Safety: block dangerous commands
+    elif FORBIDDEN_SQL.search(sql):
+        result = "Error: Only SELECT queries are allowed."
+    else:
+        try:
+            with get_db_connection(pool) as conn:
+                _, rows, truncated = fetch_rows(conn, sql)
+
+            if not rows:
+                result = "Query executed successfully. No rows returned."
+            else:
+                # JSON for the model, Arrow-backed table for the user
+                preview = rows[:100]
+                row_count = f"at least {len(rows)} (truncated)" if truncated else len(rows)
+                result = f"Found {row_count} rows:\n\n{orjson.dumps(preview, default=str).decode()}"
+                if len(rows) > 100:
+                    more = f"at least {len(rows) - 100}" if truncated else len(rows) - 100
+                    result += f"\n\n... and {more} more rows (showing first 100)"
+        except QueryCanceled:
+            result = f"Error: {QUERY_TIMEOUT_MESSAGE}"
+        except Exception:
+            error_text = traceback.format_exc()
+            result = "SQL execution failed."
+
+    message = {"role": "tool", "tool_call_id": tool_call["id"], "name": function_name, "content": result}
+    return message, preview, error_text
+
+
+async def run_tools(tool_calls):
+    """Run all tool calls concurrently, so the wait is the slowest query rather than their sum."""
+    pool = get_pool(dict_rows=True)
+    return await asyncio.gather(*(asyncio.to_thread(run_tool, pool, tc) for tc in tool_calls))
+
 
 # ============================
 # Chat input
@@ -96,6 +142,8 @@ if prompt := st.chat_input("What would you like to know from the database?"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
+    summary, upto = update_history_summary(st.session_state.messages)
+
     with st.chat_message("assistant"):
         response_placeholder = st.empty()
         full_response = ""
@@ -103,79 +151,68 @@ if prompt := st.chat_input("What would you like to know from the database?"):
         # Call Azure OpenAI with function calling
         response = client.chat.completions.create(
             model=MODEL,
-            messages=st.session_state.messages,
-            tools=tools,
+            messages=pack_history(st.session_state.messages, summary, upto),
+            tools=get_tools(),
             tool_choice="auto",
             temperature=0.2,
-            stream=False  # We'll stream manually below if needed
+            stream=True
         )
 
-        message = response.choices[0].message
-
-        # If LLM wants to call the function
-        if message.tool_calls:
-            tool_call = message.tool_calls[0]
-            function_name = tool_call.function.name
-            arguments = json.loads(tool_call.function.arguments)
-
-            if function_name == "execute_sql_query":
-                sql = arguments["sql"].strip()
-
-                # Safety: block dangerous commands
-                sql_lower = sql.lower()
-                if any(cmd in sql_lower for cmd in ["insert", "update", "delete", "drop", "create", "alter", "grant"]):
-                    result = "Error: Only SELECT queries are allowed."
-                else:
-                    try:
-                        conn = get_db_connection()
-                        cur = conn.cursor()
-                        cur.execute(sql)
-                        rows = cur.fetchall()
-                        columns = [desc[0] for desc in cur.description] if cur.description else []
-
-                        if not rows:
-                            result = "Query executed successfully. No rows returned."
-                        else:
-                            # Format nicely
-                            df = pd.DataFrame(rows, columns=columns)
-                            result = f"Found {len(df)} rows:\n\n{df.head(100).to_markdown(index=False)}"
-                            if len(df) > 100:
-                                result += f"\n\n... and {len(df) - 100} more rows (showing first 100)"
-                    except Exception as e:
-                        error_text = traceback.format_exc()
-                        st.error(error_text)  # shows real error in UI
-                        result = "SQL execution failed."
-                    finally:
-                        if 'cur' in locals():
-                            cur.close()
-                        if 'conn' in locals():
-                            conn.close()
-
-                # Append tool result and get final answer
-                # Convert message to dict before appending
-                st.session_state.messages.append({
-                    "role": message.role,
-                    "content": message.content,
-                    "tool_calls": getattr(message, "tool_calls", None)  # if you need tool_calls
+        # Stream a direct answer as it arrives and rebuild tool calls from their deltas
+        tool_calls = {}
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                full_response += delta.content
+                response_placeholder.markdown(full_response + "▌")
+            for tc in delta.tool_calls or []:
+                call = tool_calls.setdefault(tc.index, {
+                    "id": None,
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""}
                 })
-                st.session_state.messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "name": function_name,
-                    "content": result
-                })
-
-                # Second call: let LLM summarize the result
-                second_response = client.chat.completions.create(
-                    model=MODEL,
-                    messages=st.session_state.messages,
-                    temperature=0.3
-                )
-                final_message = second_response.choices[0].message.content
-                full_response = final_message
+                if tc.id:
+                    call["id"] = tc.id
+                if tc.function and tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+
+        # If LLM wants to call the function(s)
+        if tool_calls:
+            calls = list(tool_calls.values())
+            results = run_async(run_tools(calls))
+
+            # Append the tool calls and every result, in order, then get the final answer
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": full_response or None,
+                "tool_calls": calls
+            })
+            for tool_message, preview, error_text in results:
+                if error_text:
+                    st.error(error_text)  # shows real error in UI
+                if preview:
+                    st.dataframe(preview)
+                st.session_state.messages.append(tool_message)
+
+            # Second call: let LLM summarize the result, streamed token by token
+            second_response = client.chat.completions.create(
+                model=MODEL,
+                messages=pack_history(st.session_state.messages, summary, upto),
+                temperature=0.3,
+                stream=True
+            )
+            full_response = ""
+            for chunk in second_response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    full_response += chunk.choices[0].delta.content
+                    response_placeholder.markdown(full_response + "▌")
 
         else:
-            full_response = message.content or "Sorry, I couldn't process that."
+            full_response = full_response or "Sorry, I couldn't process that."
 
         response_placeholder.markdown(full_response)
         st.session_state.messages.append({"role": "assistant", "content": full_response})
@@ -0,0 +1,284 @@
+"""Shared plumbing for the Streamlit chatbots: LLM clients, PostgreSQL pool, completion caches, history.
+
+Imported once per process, so .env parsing, regex compilation and the tokenizer load
+happen once instead of on every Streamlit rerun. Config and SQL helpers that don't need
+Streamlit live in chatbot.sql and are re-exported here.
+"""
+import asyncio
+import functools
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import orjson
+import streamlit as st
+import tiktoken
+from openai import AsyncAzureOpenAI, AzureOpenAI
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+from chatbot.sql import (
+    FORBIDDEN_SQL,
+    MAX_ROWS,
+    PG,
+    PG_LIBPQ,
+    POOL_TIMEOUT_S,
+    QUERY_TIMEOUT_MESSAGE,
+    STATEMENT_TIMEOUT_MS,
+    PgConfig,
+    cache_put,
+    SQL_ARGUMENT_ERROR,
+    extract_sql,
+    fetch_rows,
+    parse_sql_argument,
+    summary_key,
+)
+
+__all__ = [
+    "MODEL",
+    "PgConfig",
+    "PG",
+    "PG_LIBPQ",
+    "get_llm",
+    "get_async_llm",
+    "get_loop",
+    "run_async",
+    "STATEMENT_TIMEOUT_MS",
+    "QUERY_TIMEOUT_MESSAGE",
+    "MAX_ROWS",
+    "get_pool",
+    "fetch_rows",
+    "extract_sql",
+    "FORBIDDEN_SQL",
+    "parse_sql_argument",
+    "SQL_ARGUMENT_ERROR",
+    "summary_key",
+    "LLM_CACHE_SIZE",
+    "cache_put",
+    "cached_completion",
+    "forget_completion",
+    "stream_completion",
+    "HISTORY_MESSAGES",
+    "HISTORY_MAX_TOKENS",
+    "count_tokens",
+    "pack_history",
+    "summary_cutoff",
+    "update_history_summary",
+]
+
+MODEL = "gpt-4o"
+API_VERSION = "2025-04-01-preview"
+
+
+# -------- LLM CLIENTS ----------
+def _http_limits():
+    return httpx.Limits(max_keepalive_connections=20, max_connections=40)
+
+
+# Created once per process so every rerun reuses the same HTTP/2 keep-alive connections.
+# No spinner: apps call this before st.set_page_config.
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    return AzureOpenAI(
+        api_key=os.environ["AZURE_OPENAI_API_KEY"],
+        api_version=API_VERSION,
+        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+        timeout=60,
+        http_client=httpx.Client(http2=True, limits=_http_limits(), timeout=60),
+    )
+
+
+def get_async_llm():
+    """One async client per session, reusing its HTTP/2 connections across reruns.
+
+    Async connections are tied to the event loop that opened them, so the client
+    lives next to the session's loop rather than in st.cache_resource.
+    """
+    if "_client" not in st.session_state:
+        st.session_state._client = AsyncAzureOpenAI(
+            api_key=os.environ["AZURE_OPENAI_API_KEY"],
+            api_version=API_VERSION,
+            azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+            timeout=60,
+            http_client=httpx.AsyncClient(http2=True, limits=_http_limits(), timeout=60),
+        )
+    return st.session_state._client
+
+
+# -------- ASYNC HELPERS ----------
+def get_loop():
+    """This session's event loop, kept across reruns."""
+    if "_loop" not in st.session_state:
+        st.session_state._loop = asyncio.new_event_loop()
+    return st.session_state._loop
+
+
+def run_async(coro):
+    return get_loop().run_until_complete(coro)
+
+
+# -------- PostgreSQL ----------
+# One pool per Streamlit process, shared by all sessions and reruns
+@st.cache_resource
+def get_pool(cfg: PgConfig = PG, dict_rows: bool = False):
+    kwargs = {
+        "host": cfg.host,
+        "dbname": cfg.db,
+        "user": cfg.user,
+        "password": cfg.password,
+        "port": cfg.port,
+        "prepare_threshold": 5,  # prepare statements seen 5 times
+        "options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+    }
+    if dict_rows:
+        kwargs["row_factory"] = dict_row
+    return ConnectionPool(min_size=2, max_size=10, kwargs=kwargs, timeout=POOL_TIMEOUT_S, open=True)
+
+
+# -------- LLM CALLS ----------
+# Entries kept in each per-session completion cache; the oldest is dropped first
+LLM_CACHE_SIZE = 128
+
+
+def _cache_key(messages, kw) -> str:
+    return hashlib.sha256(orjson.dumps([messages, kw], option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+async def cached_completion(messages, **kw):
+    """chat.completions.create, memoized per session on the exact request."""
+    kw.setdefault("model", MODEL)
+    cache = st.session_state.setdefault("_llm_cache", {})
+    key = _cache_key(messages, kw)
+    if key not in cache:
+        cache_put(cache, key, await get_async_llm().chat.completions.create(messages=messages, **kw), LLM_CACHE_SIZE)
+    return cache[key]
+
+
+def forget_completion(messages, **kw):
+    """Drop a cached_completion result, e.g. generated SQL that did not run, so a retry asks the model again."""
+    kw.setdefault("model", MODEL)
+    st.session_state.get("_llm_cache", {}).pop(_cache_key(messages, kw), None)
+
+
+async def stream_completion(placeholder, messages, **kw):
+    """Stream the reply into placeholder and return (text, function_call).
+
+    Memoized per session on the exact request, so repeating it replays the text without calling the API.
+    """
+    kw = {"model": MODEL, **kw, "stream": True}
+    cache = st.session_state.setdefault("_stream_cache", {})
+    key = _cache_key(messages, kw)
+    if key not in cache:
+        text, function_call = "", None
+        async for chunk in await get_async_llm().chat.completions.create(messages=messages, **kw):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            # Function name and arguments arrive in pieces, glue them back together
+            if delta.function_call:
+                function_call = function_call or {"name": "", "arguments": ""}
+                function_call["name"] += delta.function_call.name or ""
+                function_call["arguments"] += delta.function_call.arguments or ""
+            if delta.content:
+                text += delta.content
+                placeholder.markdown(text + "▌")
+        cache_put(cache, key, (text, function_call), LLM_CACHE_SIZE)
+    text, function_call = cache[key]
+    placeholder.markdown(text)
+    return text, function_call
+
+
+# -------- CONVERSATION HISTORY ----------
+# Only the system prompt, a rolling summary and the messages it does not cover yet are sent to the model
+HISTORY_MESSAGES = 6
+HISTORY_MAX_TOKENS = 2000
+
+HISTORY_SUMMARY_PROMPT = (
+    "Summarize the conversation between a user and a database assistant in a few sentences. "
+    "Keep table names, filters, numbers and conclusions the user may refer back to."
+)
+
+
+# Loaded on first use: tiktoken downloads the encoding the first time, which would make importing this module need network
+@functools.cache
+def _encoding():
+    return tiktoken.encoding_for_model(MODEL)
+
+
+def count_tokens(messages):
+    encoding = _encoding()
+    return sum(len(encoding.encode(m.get("content") or "")) for m in messages)
+
+
+def pack_history(msgs, summary=None, upto=1, max_tokens=HISTORY_MAX_TOKENS):
+    """Keep the system prompt, the summary of msgs[1:upto] and every later message, within max_tokens."""
+    head = msgs[:1]
+    if summary:
+        head = head + [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}]
+    # Messages the summary doesn't cover yet stay until it does, however many turns that takes
+    recent = msgs[max(upto, 1):]
+    budget = max_tokens - count_tokens(head)
+    # Only cut at user messages so tool results always follow the call they answer
+    starts = [i for i, m in enumerate(recent) if m["role"] == "user"]
+    for i in starts:
+        if i == starts[-1] or count_tokens(recent[i:]) <= budget:
+            return head + recent[i:]
+    return head + recent
+
+
+def summary_cutoff(messages, upto, k=HISTORY_MESSAGES):
+    """Where the next summary should end: on a user message, leaving at least the last k messages out.
+
+    Cutting at a user message means the unsummarized part never starts with an orphan tool result.
+    """
+    cutoff = len(messages) - k
+    while cutoff > upto and messages[cutoff]["role"] != "user":
+        cutoff -= 1
+    return cutoff
+
+
+# Summaries are produced off the script thread so they never delay a reply
+@st.cache_resource(show_spinner=False)
+def _get_summary_executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def _summarize_history(llm, messages, summary, upto, cutoff):
+    """Fold messages[upto:cutoff] into the rolling summary; returns (summary, cutoff)."""
+    transcript = "\n".join(
+        f"{m['role']}: {m['content']}"
+        for m in messages[upto:cutoff]
+        if m["role"] in ("user", "assistant") and m.get("content")
+    )
+    response = llm.chat.completions.create(
+        model=MODEL,
+        messages=[
+            {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+            {"role": "user", "content": f"Summary so far: {summary or 'none'}\n\nNew messages:\n{transcript}"}
+        ],
+        temperature=0.2
+    )
+    return response.choices[0].message.content, cutoff
+
+
+def update_history_summary(messages):
+    """Pick up a finished summary and start the next one once k more messages have aged out.
+
+    Returns (summary, upto) for pack_history: the summary covers messages[1:upto].
+    """
+    future = st.session_state.get("_summary_future")
+    if future is not None and future.done():
+        del st.session_state["_summary_future"]
+        if future.exception() is None:
+            st.session_state.history_summary, st.session_state.summary_upto = future.result()
+        future = None
+
+    summary = st.session_state.get("history_summary")
+    upto = st.session_state.get("summary_upto", 1)
+    cutoff = summary_cutoff(messages, upto)
+    if future is None and cutoff - upto >= HISTORY_MESSAGES:
+        st.session_state._summary_future = _get_summary_executor().submit(
+            _summarize_history, get_llm(), list(messages), summary, upto, cutoff
+        )
+    return summary, upto
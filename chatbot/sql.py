@@ -0,0 +1,155 @@
+"""PostgreSQL config and SQL helpers shared by the Streamlit apps and the FastAPI service.
+
+Nothing here imports Streamlit, so main.py can use it too.
+"""
+import hashlib
+import itertools
+import os
+import re
+from dataclasses import dataclass
+from uuid import uuid4
+
+import orjson
+import sqlglot
+from dotenv import load_dotenv
+from sqlglot import exp
+
+load_dotenv()
+
+
+# -------- CONFIG ----------
+# PostgreSQL settings, an immutable snapshot of the environment
+@dataclass(frozen=True, slots=True)
+class PgConfig:
+    host: str
+    db: str
+    user: str
+    password: str
+    port: int
+
+
+def pg_config_from_env(default_db="analytics_chatbot"):
+    """Read the PG_* variables; called once at import, not per request or rerun."""
+    return PgConfig(
+        host=os.getenv("PG_HOST", "localhost"),
+        db=os.getenv("PG_DB", default_db),
+        user=os.getenv("PG_USER", "postgres"),
+        password=os.getenv("PG_PASSWORD", "password"),
+        port=int(os.getenv("PG_PORT", 5432)),
+    )
+
+
+PG = pg_config_from_env()
+
+# The same settings under libpq's own PG* variable names, as app_3.py reads them
+PG_LIBPQ = PgConfig(
+    host=os.getenv("PGHOST", "localhost"),
+    db=os.getenv("PGDATABASE", "postgres"),
+    user=os.getenv("PGUSER", "postgres"),
+    password=os.getenv("PGPASSWORD", ""),
+    port=int(os.getenv("PGPORT", 5432)),
+)
+
+# Postgres cancels any statement that runs longer than this
+STATEMENT_TIMEOUT_MS = 3000
+# How long to wait for a pooled connection before giving up, e.g. while the database is down
+POOL_TIMEOUT_S = 3
+
+QUERY_TIMEOUT_MESSAGE = f"The query timed out after {STATEMENT_TIMEOUT_MS // 1000} s. Try a narrower or cheaper query."
+
+# Upper bound on rows read back from any generated query
+MAX_ROWS = 1000
+
+
+# -------- SQL EXTRACTION ----------
+_FENCE_START = re.compile(r'^```(?:sql)?\s*', re.IGNORECASE)
+_FENCE_END = re.compile(r'```$')
+_SQL_HEAD = re.compile(r'^\s*(SELECT|WITH|EXPLAIN|SHOW|PRAGMA)', re.IGNORECASE)
+
+# Statements the chatbot must never run, matched as whole words
+FORBIDDEN_SQL = re.compile(r'\b(insert|update|delete|drop|create|alter|grant)\b', re.IGNORECASE)
+
+
+# ── Robust SQL extraction (handles multiple common patterns) ──
+def extract_sql(text: str) -> str:
+    """
+    Extract SQL from LLM output, removing Markdown fences, explanations, etc.
+    Returns clean SQL or raises a clear error.
+    """
+    # Remove Markdown code blocks (```sql ... ``` or ``` ... ```)
+    sql = _FENCE_START.sub('', text)
+    sql = _FENCE_END.sub('', sql)
+
+    # Remove any leading/trailing explanations (common in GPT-4o)
+    # Keep only the first valid SQL statement if multiple are returned
+    sql = sql.strip()
+
+    # Basic safety: ensure it starts with a SQL keyword
+    if not _SQL_HEAD.match(sql):
+        raise ValueError("Generated text does not appear to be a valid SQL query")
+
+    # Optional but recommended: limit length to prevent injection/runaway queries
+    if len(sql) > 2000:
+        raise ValueError("Generated SQL is too long")
+
+    return sql
+
+
+# Tool result for a call whose arguments parse_sql_argument rejected
+SQL_ARGUMENT_ERROR = 'Error: the arguments must be a JSON object with an "sql" string.'
+
+
+def parse_sql_argument(arguments: str):
+    """The sql argument of a tool call's JSON arguments, or None if the model sent malformed arguments."""
+    try:
+        sql = orjson.loads(arguments)["sql"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        return None
+    return sql.strip() if isinstance(sql, str) else None
+
+
+def summary_key(sql_query: str, rows) -> tuple:
+    """Identify a result by its normalized SQL and a hash of the rows, independent of how the question was phrased."""
+    try:
+        canon = sqlglot.parse_one(sql_query, read="postgres").sql(dialect="postgres")
+    except sqlglot.errors.SqlglotError:
+        canon = sql_query.strip()
+    return canon, hashlib.sha1(repr(rows).encode()).hexdigest()[:16]
+
+
+def is_query(sql: str) -> bool:
+    """Whether sql is a single query that can run in a server-side cursor."""
+    try:
+        return isinstance(sqlglot.parse_one(sql, read="postgres"), exp.Query)
+    except sqlglot.errors.SqlglotError:
+        return False
+
+
+def server_cursor_name() -> str:
+    return f"ss_{uuid4().hex}"
+
+
+def fetch_rows(conn, sql, max_rows=MAX_ROWS):
+    """Read at most max_rows rows of sql, run exactly as written.
+
+    Returns (columns, rows, truncated); truncated is True when the query had more rows.
+    """
+    if is_query(sql):
+        # Server-side cursor: rows arrive in batches of itersize and the rest are never computed
+        cur = conn.cursor(name=server_cursor_name())
+        cur.itersize = 500
+    else:
+        cur = conn.cursor()
+    with cur:
+        cur.execute(sql)
+        rows = list(itertools.islice(cur, max_rows + 1))
+        columns = [desc[0] for desc in cur.description] if cur.description else []
+    return columns, rows[:max_rows], len(rows) > max_rows
+
+
+# -------- CACHES ----------
+def cache_put(cache, key, value, size):
+    """Store value under key, dropping the oldest entry once cache holds size entries."""
+    if key not in cache and len(cache) >= size:
+        cache.pop(next(iter(cache)))
+    cache[key] = value
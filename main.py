@@ -1,25 +1,72 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from openai import OpenAI
-import psycopg2
-import os
-
-client = OpenAI()
-
-app = FastAPI()
-
-# PostgreSQL connection
-def get_conn():
-    return psycopg2.connect(
-        host=os.getenv("PG_HOST", "localhost"),
-        database=os.getenv("PG_DB", "ecommerce"),
-        user=os.getenv("PG_USER", "postgres"),
-        password=os.getenv("PG_PASSWORD", "password"),
-        port=os.getenv("PG_PORT", 5432)
+from openai import AsyncOpenAI
+from psycopg.errors import QueryCanceled
+from psycopg_pool import AsyncConnectionPool
+import asyncio
+import httpx
+import orjson
+import psycopg
+
+from chatbot.sql import (
+    POOL_TIMEOUT_S,
+    QUERY_TIMEOUT_MESSAGE,
+    SQL_ARGUMENT_ERROR,
+    MAX_ROWS,
+    STATEMENT_TIMEOUT_MS,
+    cache_put,
+    is_query,
+    parse_sql_argument,
+    pg_config_from_env,
+    server_cursor_name,
+    summary_key,
+)
+
+# HTTP/2 multiplexes concurrent requests over a few kept-alive connections
+client = AsyncOpenAI(
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        timeout=60,
     )
+)
+
+# PostgreSQL settings, read once at import
+PG = pg_config_from_env(default_db="ecommerce")
+
+# PostgreSQL connection pool: 5 warm connections, up to 10 more under load
+pool = AsyncConnectionPool(
+    kwargs={
+        "host": PG.host,
+        "dbname": PG.db,
+        "user": PG.user,
+        "password": PG.password,
+        "port": PG.port,
+        "options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}",
+    },
+    min_size=5,
+    max_size=15,
+    timeout=POOL_TIMEOUT_S,
+    open=False,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await pool.open()
+    yield
+    await pool.close()
+    await client.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Bound concurrent LLM calls across requests to stay within rate limits
+llm_semaphore = asyncio.Semaphore(8)
 
-SQL_SYSTEM_PROMPT = """
-You convert user questions into SQL queries for an e-commerce PostgreSQL database.
-Return only SQL. No explanations.
+SYSTEM_PROMPT = """
+You answer analytics questions about an e-commerce PostgreSQL database.
+Use the execute_sql tool to query the database, then summarize the result
+for an analytics user in a short, clean answer.
 Tables:
 customers(customer_id, name, country)
 products(product_id, name, category, price)
@@ -27,48 +74,97 @@ orders(order_id, customer_id, order_date, total_amount)
 order_items(order_id, product_id, quantity)
 """
 
-SUMMARY_SYSTEM_PROMPT = """
-You summarize database query results for an analytics user.
-Write a short, clean answer.
-"""
+TOOLS = [
+    {
+        "type": "function",
+        "name": "execute_sql",
+        "description": "Run a read-only SQL query on the e-commerce database and return the rows.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "sql": {"type": "string", "description": "A single PostgreSQL SELECT query."}
+            },
+            "required": ["sql"],
+            "additionalProperties": False
+        }
+    }
+]
 
-def llm_generate_sql(question: str):
-    response = client.responses.create(
-        model="gpt-4.1",
-        system=SQL_SYSTEM_PROMPT,
-        input=[{"role": "user", "content": question}]
-    )
-    return response.output_text.strip()
+async def llm_respond(**kwargs):
+    async with llm_semaphore:
+        return await client.responses.create(
+            model="gpt-4.1",
+            instructions=SYSTEM_PROMPT,
+            tools=TOOLS,
+            parallel_tool_calls=False,
+            **kwargs
+        )
 
-def llm_summarize(question, sql, rows):
-    payload = f"""
-User question: {question}
-SQL executed: {sql}
-Result: {rows}
-"""
-    response = client.responses.create(
-        model="gpt-4.1",
-        system=SUMMARY_SYSTEM_PROMPT,
-        input=[{"role": "user", "content": payload}]
-    )
-    return response.output_text.strip()
+# Answers already given for a (normalized SQL, result) pair; oldest entries are dropped first
+SUMMARY_CACHE_SIZE = 1024
+summary_cache = {}
+
+async def run_query(sql):
+    """At most MAX_ROWS rows of sql, and whether the query had more."""
+    # The pool commits on exit and takes the connection back
+    async with pool.connection() as conn:
+        # Server-side cursor: rows past MAX_ROWS + 1 are never computed or sent
+        cursor = conn.cursor(name=server_cursor_name()) if is_query(sql) else conn.cursor()
+        async with cursor as cur:
+            await cur.execute(sql)
+            rows = await cur.fetchmany(MAX_ROWS + 1)
+    return rows[:MAX_ROWS], len(rows) > MAX_ROWS
 
 @app.get("/ask")
-def ask(question: str):
-    sql = llm_generate_sql(question)
+async def ask(question: str):
+    # One logical turn: the model writes SQL as a tool call, we run it and
+    # hand back only the rows; the conversation stays on the server.
+    response = await llm_respond(
+        input=[{"role": "user", "content": question}],
+        tool_choice="auto"
+    )
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(sql)
-    rows = cur.fetchall()
-    conn.commit()
-    cur.close()
-    conn.close()
+    sql, rows, truncated = None, [], False
+    answer = response.output_text.strip()
+    call = next((item for item in response.output if item.type == "function_call"), None)
+    if call is not None:
+        # Errors go back to the model as the tool result instead of failing the request;
+        # only results the database returned are cached
+        sql, key = parse_sql_argument(call.arguments), None
+        if sql is None:
+            output = SQL_ARGUMENT_ERROR
+        else:
+            try:
+                rows, truncated = await run_query(sql)
+                output = orjson.dumps(rows, default=str).decode()
+                if truncated:
+                    output += f"\n\nRow count: at least {len(rows)} (truncated)"
+                key = summary_key(sql, rows)
+            except QueryCanceled:
+                output = f"Error: {QUERY_TIMEOUT_MESSAGE}"
+            except psycopg.Error as e:
+                output = f"Error: {e}"
 
-    summary = llm_summarize(question, sql, rows)
+        if key in summary_cache:
+            answer = summary_cache[key]
+        else:
+            response = await llm_respond(
+                previous_response_id=response.id,
+                input=[{
+                    "type": "function_call_output",
+                    "call_id": call.call_id,
+                    "output": output
+                }],
+                # Answer from this result; another tool call would leave output_text empty
+                tool_choice="none"
+            )
+            answer = response.output_text.strip()
+            if key is not None:
+                cache_put(summary_cache, key, answer, SUMMARY_CACHE_SIZE)
 
     return {
-        "answer": summary,
+        "answer": answer,
         "sql": sql,
-        "rows": rows
+        "rows": rows,
+        "truncated": truncated
     }
@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip("streamlit")
+
+from chatbot import core  # noqa: E402
+from chatbot.core import HISTORY_MESSAGES, pack_history, summary_cutoff  # noqa: E402
+
+SYSTEM = {"role": "system", "content": "system prompt"}
+
+
+def tool_turn(i):
+    """One app_4 turn: question, tool call, tool result, answer."""
+    return [
+        {"role": "user", "content": f"q{i}"},
+        {"role": "assistant", "content": None, "tool_calls": [{"id": f"c{i}"}]},
+        {"role": "tool", "tool_call_id": f"c{i}", "content": f"rows {i}"},
+        {"role": "assistant", "content": f"a{i}"},
+    ]
+
+
+def conversation(turns):
+    msgs = [SYSTEM]
+    for i in range(turns):
+        msgs += tool_turn(i)
+    return msgs
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # One token per word, so the tests need no tiktoken download
+    monkeypatch.setattr(core, "count_tokens", lambda ms: sum(len((m.get("content") or "").split()) for m in ms))
+
+
+# -------- pack_history ----------
+def test_pack_history_keeps_unsummarized_turns():
+    msgs = conversation(3) + [{"role": "user", "content": "q3"}]
+    assert pack_history(msgs) == msgs
+
+
+def test_pack_history_replaces_summarized_part_with_summary():
+    msgs = conversation(4)
+    packed = pack_history(msgs, summary="earlier", upto=9)
+    assert packed[0] == SYSTEM
+    assert packed[1]["role"] == "system" and "earlier" in packed[1]["content"]
+    assert packed[2:] == msgs[9:]
+
+
+def test_pack_history_cuts_only_at_user_messages():
+    msgs = conversation(4)
+    packed = pack_history(msgs, max_tokens=6)
+    assert packed[1]["role"] == "user"
+    assert packed[1:] == msgs[msgs.index(packed[1]):]
+
+
+def test_pack_history_keeps_last_turn_over_budget():
+    msgs = conversation(2)
+    packed = pack_history(msgs, max_tokens=0)
+    assert packed == [SYSTEM] + tool_turn(1)
+
+
+# -------- summary_cutoff ----------
+@pytest.mark.parametrize("turns", range(1, 8))
+def test_summary_cutoff_lands_on_user_message(turns):
+    msgs = conversation(turns)
+    cutoff = summary_cutoff(msgs, 1)
+    assert cutoff <= len(msgs) - HISTORY_MESSAGES
+    if cutoff > 1:
+        assert msgs[cutoff]["role"] == "user"
+
+
+def test_summary_cutoff_stops_walking_back_at_upto():
+    # len - k lands on turn 2's tool result; the walk back to a user message stops at upto
+    msgs = conversation(4)
+    assert summary_cutoff(msgs, 10) == 10
+
+
+def test_summary_cutoff_leaves_nothing_to_summarize_in_a_short_tail():
+    msgs = conversation(3)
+    assert summary_cutoff(msgs, 9) - 9 < HISTORY_MESSAGES
+
+
+def test_every_message_is_summarized_or_sent():
+    # Replays update_history_summary's bookkeeping with the summary arriving one turn late
+    msgs, upto, pending = [SYSTEM], 1, None
+    for i in range(12):
+        msgs += [{"role": "user", "content": f"q{i}"}]
+        if pending is not None:
+            upto, pending = pending, None
+        cutoff = summary_cutoff(msgs, upto)
+        if cutoff - upto >= HISTORY_MESSAGES:
+            pending = cutoff
+
+        packed = pack_history(msgs, summary="s" if upto > 1 else None, upto=upto)
+        sent = packed[2:] if upto > 1 else packed[1:]
+        assert sent == msgs[upto:]
+        assert msgs[upto]["role"] == "user"
+        msgs += tool_turn(i)[1:]
@@ -0,0 +1,121 @@
+import pytest
+
+from chatbot.sql import (
+    MAX_ROWS,
+    cache_put,
+    extract_sql,
+    fetch_rows,
+    is_query,
+    parse_sql_argument,
+    summary_key,
+)
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.conn, self.name = conn, name
+        self.description = [("n",)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        self.conn.executed.append((self.name, sql))
+
+    def __iter__(self):
+        return iter((i,) for i in range(self.conn.row_count))
+
+
+class FakeConn:
+    def __init__(self, row_count):
+        self.row_count = row_count
+        self.executed = []
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+
+# -------- fetch_rows ----------
+@pytest.mark.parametrize("row_count, truncated", [(MAX_ROWS, False), (MAX_ROWS + 1, True), (5 * MAX_ROWS, True)])
+def test_fetch_rows_flags_truncation_past_max_rows(row_count, truncated):
+    columns, rows, was_truncated = fetch_rows(FakeConn(row_count), "SELECT n FROM t")
+    assert columns == ["n"]
+    assert len(rows) == min(row_count, MAX_ROWS)
+    assert was_truncated is truncated
+
+
+def test_fetch_rows_runs_sql_as_written():
+    conn = FakeConn(1)
+    sql = "SELECT U&'d\\0061t'"
+    fetch_rows(conn, sql)
+    [(name, executed)] = conn.executed
+    assert executed == sql
+    assert name is not None  # a query gets a server-side cursor
+
+
+def test_fetch_rows_falls_back_to_plain_cursor_on_untokenizable_sql():
+    conn = FakeConn(1)
+    sql = "SELECT E'it\\'s'"
+    fetch_rows(conn, sql)
+    assert conn.executed == [(None, sql)]
+
+
+def test_is_query():
+    assert is_query("SELECT 1")
+    assert is_query("WITH x AS (SELECT 1) SELECT * FROM x")
+    assert not is_query("SHOW search_path")
+    assert not is_query("SELECT 'abc")
+
+
+# -------- summary_key ----------
+def test_summary_key_normalizes_formatting():
+    assert summary_key("select  a from t", [(1,)]) == summary_key("SELECT a FROM t", [(1,)])
+
+
+def test_summary_key_depends_on_rows():
+    assert summary_key("SELECT a FROM t", [(1,)]) != summary_key("SELECT a FROM t", [(2,)])
+
+
+@pytest.mark.parametrize("sql", ["SELECT E'it\\'s'", "SELECT 'abc"])
+def test_summary_key_falls_back_on_untokenizable_sql(sql):
+    canon, _ = summary_key(f"  {sql} ", [])
+    assert canon == sql
+
+
+# -------- extract_sql ----------
+def test_extract_sql_strips_fences():
+    assert extract_sql("```sql\nSELECT 1\n```") == "SELECT 1"
+
+
+def test_extract_sql_rejects_prose():
+    with pytest.raises(ValueError):
+        extract_sql("Hello! How can I help?")
+
+
+# -------- parse_sql_argument ----------
+@pytest.mark.parametrize("arguments, expected", [
+    ('{"sql": " SELECT 1 "}', "SELECT 1"),
+    ("not json", None),
+    ('{"query": "SELECT 1"}', None),
+    ('{"sql": 1}', None),
+    ("[1]", None),
+])
+def test_parse_sql_argument(arguments, expected):
+    assert parse_sql_argument(arguments) == expected
+
+
+# -------- cache_put ----------
+def test_cache_put_drops_oldest_first():
+    cache = {}
+    for i in range(5):
+        cache_put(cache, i, str(i), 3)
+    assert list(cache) == [2, 3, 4]
+
+
+def test_cache_put_overwrites_without_evicting():
+    cache = {"a": 1, "b": 2}
+    cache_put(cache, "a", 3, 2)
+    assert cache == {"a": 3, "b": 2}